@@ -15,8 +15,9 @@ class AlarmsParserTestCase(unittest.TestCase):
         test_alarm = alarms[0]
         self.assertEqual(test_alarm._name, 'NAME', msg="Incorrect name.")
         self.assertEqual(test_alarm._index, 1000, msg="Incorrect index.")
-        self.assertIn(CLEARED, test_alarm._levels.keys(), msg="No cleared state.")
-        self.assertIn(CRITICAL, test_alarm._levels.keys(), msg="No critical state.")
+        severities = [level._itu_severity for level in test_alarm._levels]
+        self.assertIn(CLEARED, severities, msg="No cleared state.")
+        self.assertIn(CRITICAL, severities, msg="No critical state.")
 
     def testRenderAlarm(self):
         alarms = parse_alarms_file('metaswitch/common/test/test_valid_alarms.json')